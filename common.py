@@ -8,25 +8,42 @@
 
 import numpy as np
 import os
+import sqlite3
 import sys
 import tomllib
 
 from collections import namedtuple
-from math import *
-from scipy.interpolate import pchip_interpolate
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, groupby, repeat
+from math import floor, log10
+from operator import itemgetter
+from scipy.interpolate import PchipInterpolator
+
+# numba is optional. If it's installed, we use a JIT-compiled PCHIP implementation
+# for curve interpolation, otherwise we fall back to scipy's implementation
+try:
+  import numba
+except ImportError:
+  numba = None
 
 DEFAULT_SSIMU2_LO = 30
 DEFAULT_SSIMU2_HI = 90
 DEFAULT_SSIMU2_STEP = 1
 
+# Methods which can be used to interpolate between the measured data points.
+# PCHIP gives smooth curves; linear interpolation is cheaper, and at the default step size
+# the difference is rarely visible
+INTERPOLATION_METHODS = ["pchip", "linear"]
+DEFAULT_INTERPOLATION = "pchip"
+
 # Note: Speed settings are called "speed" if higher numbers are faster,
 # and "effort" if higher numbers are slower
 DEFAULT_SETTINGS = {
-  "aom": {"speed": "6", "tune": None},
-  "svt": {"speed": "6", "tune": None},
-  "rav1e": {"speed": "6"},
+  "aom": {"speed": "6", "tune": None, "threads": 1},
+  "svt": {"speed": "6", "tune": None, "threads": 1},
+  "rav1e": {"speed": "6", "threads": 1},
   "tinyavif": {},
-  "jpegxl": {"effort": "7"},
+  "jpegxl": {"effort": "7", "threads": 1},
   "jpegli": {},
   "webp": {"effort": "4", "preset": "default"},
   "webp_nll": {"effort": "4", "preset": "default"},
@@ -61,42 +78,82 @@ CACHE_TAG="""Signature: 8a477f597d28d172789f06886806bc55
 
 Source = namedtuple("Source", ["tag", "path"])
 Encoder = namedtuple("Encoder", ["tag", "encoder", "format", "settings"])
-EncodeData = namedtuple("EncodeData", ["size", "real_runtime", "user_runtime", "sys_runtime", "mem_peak",
-                                       "ssimu2", "butteraugli", "fullres_ssimu2", "fullres_butteraugli"])
+# Results for one (encoder, source, resolution), stored column-wise, with one array per field
+ResultColumns = namedtuple("ResultColumns", ["size", "real_runtime", "ssimu2", "fullres_ssimu2"])
 
 Curve = namedtuple("Curve", ["label", "encoder_indices"])
 
+# Cache of the (resolution_index, width, height) list for each source, as the same sources
+# are looked up once per encoder when computing curves
+SOURCE_RESOLUTIONS = {}
+
+# Cache of results loaded from the database, keyed by (encoder tag, sort column). Each entry
+# maps source tags to that source's results, as returned by load_encoder_results()
+ENCODER_RESULTS = {}
+
+# Cache of log scale tick labels, keyed by (tick value, suffix). matplotlib formats every
+# tick each time a figure is drawn, but only a small set of tick values ever comes up
+TICK_LABEL_CACHE = {}
+
 def print_error(message):
   print(f"Error: {message}", file=sys.stderr)
 
+# Pad `text` with spaces on both sides to exactly `length` characters.
+# If the padding can't be split evenly, the extra space goes on the right.
+# Note that str.center() is not equivalent, as it sometimes puts the extra space on the left
 def center_text(text, length):
-  assert length >= len(text)
-  left_padding = (length - len(text)) // 2
-  right_padding = (length - len(text) + 1) // 2
-  result = " " * left_padding + text + " " * right_padding
-  assert len(result) == length
-  return result
+  if len(text) > length:
+    raise ValueError(f"Text {text!r} is longer than {length} characters")
+  return f"{text:^{length}}"
+
+# Custom function to format log scale ticks nicely, with an optional suffix on each label
+# Based on https://stackoverflow.com/a/17209836
+def format_log_tick(value, suffix=""):
+  key = (value, suffix)
+  if key not in TICK_LABEL_CACHE:
+    TICK_LABEL_CACHE[key] = format_log_tick_uncached(value, suffix)
+  return TICK_LABEL_CACHE[key]
+
+def format_log_tick_uncached(value, suffix):
+  exp = int(floor(log10(value)))
+  base = int(round(value / 10**exp))
+
+  # Skip labelling the 5, 7, and 9 subdivisions to avoid crowding.
+  # These skipped subdivisions still get a tick mark on the axis to indicate
+  # where they are
+  if base in (5, 7, 9): return ""
+
+  if exp >= 1:
+    decimal_places = 0
+  elif exp == 0:
+    # In this case the tick values are single-digit integers,
+    # but add a decimal place anyway because 0.6, 0.8, 1.0, 2.0, ... looks prettier
+    # than 0.6, 0.8, 1, 2, ...
+    decimal_places = 1
+  else:
+    # For values < 1, display with the minimal number of decimal places
+    decimal_places = -exp
+
+  return f"{value:.{decimal_places}f}{suffix}"
 
 # Flatten a list of lists (or a generator of lists) into a single list
 def flatten(list_of_lists):
-  result = []
-  for l in list_of_lists:
-    result.extend(l)
-  return result
+  return list(chain.from_iterable(list_of_lists))
 
 def add_cache_tag(cachedir):
   cache_tag_path = os.path.join(cachedir, "CACHEDIR.TAG")
   if not os.path.exists(cache_tag_path):
-    open(cache_tag_path, "w").write(CACHE_TAG)
+    with open(cache_tag_path, "w") as f:
+      f.write(CACHE_TAG)
 
 def load_source_list(source_list_path):
   sources = []
 
   # Treat all entries in this list file as paths relative to the list itself
-  source_list_basename = os.path.basename(source_list_path)
-  source_list_dir = os.path.dirname(source_list_path)
+  source_list_dir = os.path.abspath(os.path.dirname(source_list_path))
 
-  data = tomllib.load(open(source_list_path, "rb"))
+  with open(source_list_path, "rb") as f:
+    data = tomllib.load(f)
 
   for tag, params in data["sources"].items():
     # Allow sources to be specified as `tag = path` if no other settings are needed
@@ -107,7 +164,7 @@ def load_source_list(source_list_path):
       path = params["path"]
 
     # Normalize parameters
-    full_path = os.path.abspath(os.path.join(source_list_dir, path))
+    full_path = os.path.normpath(os.path.join(source_list_dir, path))
 
     # Check that the provided parameters make sense
     if not os.path.exists(full_path):
@@ -121,11 +178,8 @@ def load_source_list(source_list_path):
 def load_encoder_list(encoder_list_path):
   encoders = []
 
-  # Treat all entries in this list file as paths relative to the list itself
-  encoder_list_basename = os.path.basename(encoder_list_path)
-  encoder_list_dir = os.path.dirname(encoder_list_path)
-
-  data = tomllib.load(open(encoder_list_path, "rb"))
+  with open(encoder_list_path, "rb") as f:
+    data = tomllib.load(f)
 
   for tag, params in data["encoders"].items():
     # Check that the provided parameters make sense
@@ -202,14 +256,183 @@ def calculate_target_ssimu2_points(range, step):
   num_steps = int((hi - lo) // step) + 1
   target_ssimu2_points = np.linspace(lo, hi, num_steps)
 
+  # These points are shared by every curve we compute, so make sure nothing can modify them
+  target_ssimu2_points.setflags(write=False)
+
   return target_ssimu2_points
 
-def interpolate_curves(db, encoder, source, target_ssimu2_points):
+# Open the results database for the plot scripts, which only ever read from it.
+# Refuse writes, so that a bug can't damage the results, and let SQLite memory-map the file
+# and keep a larger page cache, as the same tables get scanned once per encoder
+def open_database_readonly(path):
+  db = sqlite3.connect(path)
+  db.execute("PRAGMA query_only=1")
+  db.execute("PRAGMA mmap_size=268435456") # 256MiB
+  db.execute("PRAGMA cache_size=-65536") # 64MiB
+  return db
+
+# Look up the list of (resolution_index, width, height) tuples for a given source,
+# sorted so that the full-res source is the first entry
+def get_source_resolutions(db, source):
+  if source.tag not in SOURCE_RESOLUTIONS:
+    SOURCE_RESOLUTIONS[source.tag] = db.execute("SELECT resolution_index, width, height FROM sources "
+                                                "WHERE source = :source ORDER BY resolution_index;",
+                                                {"source": source.tag}).fetchall()
+  return SOURCE_RESOLUTIONS[source.tag]
+
+# Fetch the results for all resolutions of a given (encoder, source) pair.
+# Returns a list with one ResultColumns entry per resolution, in the same order as `resolutions`,
+# with each resolution's results sorted by `order_by`.
+#
+# The results for every source are loaded the first time an encoder is requested, so that
+# there's only one query per encoder rather than one per (encoder, source) pair
+def load_results(db, encoder, source, resolutions, order_by):
+  key = (encoder.tag, order_by)
+  if key not in ENCODER_RESULTS:
+    ENCODER_RESULTS[key] = load_encoder_results(db, encoder, order_by)
+
+  columns = ENCODER_RESULTS[key].get(source.tag)
+  if columns is None:
+    columns = np.empty((5, 0))
+
+  # Rows are grouped by resolution index, so find the boundaries between groups
+  resolution_indices = [resolution_index for (resolution_index, _, _) in resolutions]
+  starts = np.searchsorted(columns[0], resolution_indices, side="left")
+  ends = np.searchsorted(columns[0], resolution_indices, side="right")
+
+  return [ResultColumns._make(columns[1:, start:end]) for (start, end) in zip(starts, ends)]
+
+# Fetch all of the results for a given encoder in a single query.
+# Returns a dict mapping each source tag to a 2D float array with one row per field
+# (resolution_index, size, real_runtime, ssimu2, fullres_ssimu2), sorted by resolution index
+# and then by `order_by`.
+# Note: `order_by` is spliced into the query as-is, so must be a column name, not user input.
+def load_encoder_results(db, encoder, order_by):
+  query = db.execute("SELECT source, resolution_index, size, real_runtime, ssimu2, fullres_ssimu2 FROM results "
+                     "WHERE encoder = :encoder "
+                     f"ORDER BY source, resolution_index, {order_by};",
+                     {"encoder": encoder.tag})
+
+  encoder_results = {}
+  for source_tag, rows in groupby(query, key=itemgetter(0)):
+    # Stream each source's rows straight into a float array, without building an intermediate
+    # list of tuples, then transpose so that each field is stored contiguously
+    columns = np.fromiter((row[1:] for row in rows), dtype=np.dtype((np.float64, 5)))
+    encoder_results[source_tag] = columns.reshape(-1, 5).T.copy()
+
+  return encoder_results
+
+# PCHIP interpolation of each column of `y` (sampled at the strictly increasing points `x`)
+# onto the points `target_x`.
+#
+# This is a direct port of scipy's PchipInterpolator: the slopes at each point are set using the
+# Fritsch-Carlson weighted harmonic mean of the neighbouring secant slopes (or zero at local extrema),
+# the endpoint slopes use a one-sided three-point estimate, and then each interval is evaluated
+# as a cubic Hermite polynomial. Points outside of [x[0], x[-1]] are extrapolated from the end intervals.
+def pchip_kernel(x, y, target_x):
+  num_points = x.shape[0]
+  num_columns = y.shape[1]
+  num_targets = target_x.shape[0]
+
+  h = x[1:] - x[:-1]
+  slopes = np.empty(num_points)
+  out = np.empty((num_targets, num_columns))
+
+  for column in range(num_columns):
+    m = (y[1:, column] - y[:-1, column]) / h
+
+    if num_points == 2:
+      # Just linear interpolation
+      slopes[0] = m[0]
+      slopes[1] = m[0]
+    else:
+      for k in range(1, num_points - 1):
+        if m[k-1] * m[k] <= 0:
+          slopes[k] = 0.0
+        else:
+          w1 = 2.0 * h[k] + h[k-1]
+          w2 = h[k] + 2.0 * h[k-1]
+          slopes[k] = (w1 + w2) / (w1 / m[k-1] + w2 / m[k])
+
+      for (k, h0, h1, m0, m1) in ((0, h[0], h[1], m[0], m[1]),
+                                  (num_points - 1, h[-1], h[-2], m[-1], m[-2])):
+        d = ((2.0 * h0 + h1) * m0 - h0 * m1) / (h0 + h1)
+        if np.sign(d) != np.sign(m0):
+          d = 0.0
+        elif np.sign(m0) != np.sign(m1) and abs(d) > 3.0 * abs(m0):
+          d = 3.0 * m0
+        slopes[k] = d
+
+    for j in range(num_targets):
+      i = np.searchsorted(x, target_x[j], side="right") - 1
+      i = min(max(i, 0), num_points - 2)
+
+      s = target_x[j] - x[i]
+      c0 = y[i, column]
+      c1 = slopes[i]
+      c2 = (3.0 * m[i] - 2.0 * slopes[i] - slopes[i+1]) / h[i]
+      c3 = (slopes[i] + slopes[i+1] - 2.0 * m[i]) / (h[i] * h[i])
+      out[j, column] = c0 + s * (c1 + s * (c2 + s * c3))
+
+  return out
+
+if numba is not None:
+  pchip_kernel = numba.njit(cache=True)(pchip_kernel)
+
+# Interpolate log(bpp) and log(nspp) curves, sampled at the (sorted) SSIMU2 scores in `ssimu2_points`,
+# onto `target_ssimu2_points`, using one of INTERPOLATION_METHODS. For PCHIP, both metrics are
+# interpolated together, so that the setup for a given set of SSIMU2 scores only needs to be done once.
+def interpolate_log_metrics(ssimu2_points, log_bpp_points, log_nspp_points, target_ssimu2_points, interpolation):
+  if interpolation == "linear":
+    return (np.interp(target_ssimu2_points, ssimu2_points, log_bpp_points),
+            np.interp(target_ssimu2_points, ssimu2_points, log_nspp_points))
+
+  # pchip_kernel() would divide by zero if two points share an SSIMU2 score, and silently return
+  # inf/NaN curves. So check up-front, raising the same error that PchipInterpolator does
+  if np.any(np.diff(ssimu2_points) <= 0):
+    raise ValueError("`x` must be strictly increasing sequence.")
+
+  if numba is not None:
+    result = pchip_kernel(np.ascontiguousarray(ssimu2_points, dtype=np.float64),
+                          np.column_stack((log_bpp_points, log_nspp_points)),
+                          np.ascontiguousarray(target_ssimu2_points, dtype=np.float64))
+  else:
+    interpolator = PchipInterpolator(ssimu2_points, np.column_stack((log_bpp_points, log_nspp_points)), axis=0)
+    result = interpolator(target_ssimu2_points)
+  return (result[:, 0], result[:, 1])
+
+# Compute the full-res curve for one resolution's worth of results (a ResultColumns from load_results()).
+# That is, sizes and runtimes relative to the full-res pixel count, against full-res SSIMU2 scores.
+#
+# We might not necessarily have enough data to cover the full target SSIMU2 range. This is okay,
+# we just need to filter the curve so that we have appropriate data. So this returns a slice
+# selecting the target SSIMU2 points which are covered, alongside the log(bpp) and log(nspp) values
+# at those points.
+def interpolate_fullres_curve(results, fullres_num_pixels, target_ssimu2_points, interpolation):
+  order = np.argsort(results.fullres_ssimu2, kind="stable")
+
+  fullres_log_bpp_points = np.log(results.size[order] * (8.0 / fullres_num_pixels))
+  fullres_log_nspp_points = np.log(results.real_runtime[order] * (1000000000.0 / fullres_num_pixels))
+  fullres_ssimu2_points = results.fullres_ssimu2[order]
+
+  min_fullres_ssimu2 = fullres_ssimu2_points[0]
+  max_fullres_ssimu2 = fullres_ssimu2_points[-1]
+
+  # Target points are in ascending order, so the covered points form a contiguous range
+  fullres_range = slice(np.searchsorted(target_ssimu2_points, min_fullres_ssimu2, side="left"),
+                        np.searchsorted(target_ssimu2_points, max_fullres_ssimu2, side="right"))
+  fullres_target_ssimu2_points = target_ssimu2_points[fullres_range]
+
+  fullres_log_bpp, fullres_log_nspp = interpolate_log_metrics(fullres_ssimu2_points, fullres_log_bpp_points,
+                                                              fullres_log_nspp_points, fullres_target_ssimu2_points,
+                                                              interpolation)
+
+  return (fullres_range, fullres_log_bpp, fullres_log_nspp)
+
+def interpolate_curves(db, encoder, source, target_ssimu2_points, interpolation):
   curves = []
 
-  resolutions = db.execute("SELECT resolution_index, width, height FROM sources WHERE source = :source;",
-                           {"source": source.tag}).fetchall()
-  resolutions.sort()
+  resolutions = get_source_resolutions(db, source)
   num_resolutions = len(resolutions)
 
   fullres_width = resolutions[0][1]
@@ -220,85 +443,57 @@ def interpolate_curves(db, encoder, source, target_ssimu2_points):
   multires_log_bpp = np.full(num_target_ssimu2_points, np.inf)
   multires_log_nspp = np.full(num_target_ssimu2_points, np.inf)
 
-  min_target_ssimu2 = min(target_ssimu2_points)
-  max_target_ssimu2 = max(target_ssimu2_points)
-
-  for (resolution_index, width, height) in resolutions:
-    num_pixels = width * height
+  # Target points are generated in ascending order by calculate_target_ssimu2_points()
+  min_target_ssimu2 = target_ssimu2_points[0]
+  max_target_ssimu2 = target_ssimu2_points[-1]
 
-    query = db.execute("SELECT size, real_runtime, user_runtime, sys_runtime, mem_peak, "
-                       "ssimu2, butteraugli, fullres_ssimu2, fullres_butteraugli FROM results "
-                       "WHERE encoder = :encoder AND source = :source AND resolution_index = :resolution_index;",
-                       {"encoder": encoder.tag, "source": source.tag, "resolution_index": resolution_index})
+  # Fetch results in ascending order of SSIMU2 scores within each resolution,
+  # ready for the same-res curves
+  all_results = load_results(db, encoder, source, resolutions, "ssimu2")
 
-    # Map result rows to a proper object
-    query.row_factory = lambda _, row: EncodeData._make(row)
-    results = query.fetchall()
+  for (resolution_index, width, height), results in zip(resolutions, all_results):
+    num_pixels = width * height
 
-    num_points = len(results)
+    num_points = len(results.size)
     if num_points == 0:
       print_error(f"No encodes found for encoder {encoder}, source {source}")
       sys.exit(1)
 
-    results.sort(key = lambda row: row.ssimu2) # Sort in ascending order of SSIMU2 scores
-
     # TODO: Filter to keep only points on the convex hull
-    min_ssimu2 = results[0].ssimu2
-    max_ssimu2 = results[-1].ssimu2
+    sameres_ssimu2_points = results.ssimu2
+    min_ssimu2 = sameres_ssimu2_points[0]
+    max_ssimu2 = sameres_ssimu2_points[-1]
     if min_ssimu2 > min_target_ssimu2 or max_ssimu2 < max_target_ssimu2:
       print_error(f"SSIMU2 scores for (encoder={encoder.tag}, source={source.tag}) don't cover a wide enough range")
       print_error(f"SSIMU2 range covered is [{min_ssimu2:.1f}, {max_ssimu2:.1f}] vs. expected [{min_target_ssimu2:.1f}, {max_target_ssimu2:.1f}]")
       sys.exit(1)
 
-    # Split results and map to log-space for interpolation
+    # Map results to log-space for interpolation
     # (which will make it easier to take geometric means later)
     # Also convert from absolute size (in bytes) and runtime (in seconds)
     # to bits/pixel and ns/pixel respectively
-    sameres_log_bpp_points = np.zeros(num_points)
-    sameres_log_nspp_points = np.zeros(num_points)
-    sameres_ssimu2_points = np.zeros(num_points)
-    for row_index, row in enumerate(results):
-      sameres_log_bpp_points[row_index] = log(row.size * 8.0 / num_pixels)
-      sameres_log_nspp_points[row_index] = log(row.real_runtime * 1000000000.0 / num_pixels)
-      sameres_ssimu2_points[row_index] = row.ssimu2
+    sameres_log_bpp_points = np.log(results.size * (8.0 / num_pixels))
+    sameres_log_nspp_points = np.log(results.real_runtime * (1000000000.0 / num_pixels))
 
     # Output same-res curve...
-    sameres_log_bpp = pchip_interpolate(sameres_ssimu2_points, sameres_log_bpp_points, target_ssimu2_points)
-    sameres_log_nspp = pchip_interpolate(sameres_ssimu2_points, sameres_log_nspp_points, target_ssimu2_points)
+    sameres_log_bpp, sameres_log_nspp = interpolate_log_metrics(sameres_ssimu2_points, sameres_log_bpp_points,
+                                                                sameres_log_nspp_points, target_ssimu2_points,
+                                                                interpolation)
     curves.append((resolution_index, sameres_log_bpp, sameres_log_nspp))
 
 
-    # Re-sort for fullres curve generation
-    results.sort(key = lambda row: row.fullres_ssimu2)
-
-    fullres_log_bpp_points = np.zeros(num_points)
-    fullres_log_nspp_points = np.zeros(num_points)
-    fullres_ssimu2_points = np.zeros(num_points)
-    for row_index, row in enumerate(results):
-      fullres_log_bpp_points[row_index] = log(row.size * 8.0 / fullres_num_pixels)
-      fullres_log_nspp_points[row_index] = log(row.real_runtime * 1000000000.0 / fullres_num_pixels)
-      fullres_ssimu2_points[row_index] = row.fullres_ssimu2
-
-    # For the full-res curve (which gets merged into the multires curve), we might not necessarily
-    # have enough data to cover the full target SSIMU2 range. This is okay, we just need to filter
-    # the curve so that we have appropriate data
-    min_fullres_ssimu2 = results[0].fullres_ssimu2
-    max_fullres_ssimu2 = results[-1].fullres_ssimu2
-
-    fullres_target_ssimu2_points = []
-    fullres_index_map = []
-    for index, target_ssimu2 in enumerate(target_ssimu2_points):
-      if min_fullres_ssimu2 <= target_ssimu2 <= max_fullres_ssimu2:
-        fullres_target_ssimu2_points.append(target_ssimu2)
-        fullres_index_map.append(index)
-
-    # ...and merge fullres curve into multires curve
-    fullres_log_bpp = pchip_interpolate(fullres_ssimu2_points, fullres_log_bpp_points, fullres_target_ssimu2_points)
-    fullres_log_nspp = pchip_interpolate(fullres_ssimu2_points, fullres_log_nspp_points, fullres_target_ssimu2_points)
-    for i in range(len(fullres_target_ssimu2_points)):
-      if fullres_log_bpp[i] < multires_log_bpp[fullres_index_map[i]]:
-        multires_log_bpp[fullres_index_map[i]] = fullres_log_bpp[i]
-        multires_log_nspp[fullres_index_map[i]] = fullres_log_nspp[i]
+    # Compute fullres curve...
+    fullres_range, fullres_log_bpp, fullres_log_nspp = \
+      interpolate_fullres_curve(results, fullres_num_pixels, target_ssimu2_points, interpolation)
+
+    # ...and merge it into multires curve, keeping whichever resolution gives
+    # the smallest size at each target SSIMU2 point
+    # (Slicing gives views, so assigning through these updates the multires curve in place)
+    covered_log_bpp = multires_log_bpp[fullres_range]
+    covered_log_nspp = multires_log_nspp[fullres_range]
+    better = fullres_log_bpp < covered_log_bpp
+    covered_log_bpp[better] = fullres_log_bpp[better]
+    covered_log_nspp[better] = fullres_log_nspp[better]
 
   # Output multires curve
   # First check that we got data for all points. This should always be the case, because the first
@@ -310,3 +505,48 @@ def interpolate_curves(db, encoder, source, target_ssimu2_points):
   curves.append((num_resolutions, multires_log_bpp, multires_log_nspp))
 
   return curves
+
+# Compute the mean curves across all of the given sources, for each encoder.
+# Returns a tuple (mean_log_bpp, mean_log_nspp), each indexed as [encoder_index, resolution_index, ssimu2_index],
+# with the multires curve stored after the `num_resolution_points` same-res curves.
+#
+# Each encoder's curves are independent, so they're computed in parallel, in separate processes
+# which each open their own connection to the database
+def mean_log_curves(database_path, encoders, sources, target_ssimu2_points, num_resolution_points,
+                    interpolation):
+  args = (repeat(database_path), encoders, repeat(sources),
+          repeat(target_ssimu2_points), repeat(num_resolution_points), repeat(interpolation))
+
+  num_workers = min(len(encoders), os.process_cpu_count())
+  if num_workers > 1:
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+      encoder_curves = list(executor.map(encoder_log_curves, *args))
+  else:
+    # Not worth starting up any worker processes
+    encoder_curves = list(map(encoder_log_curves, *args))
+
+  # Stack into arrays indexed as [source_index, encoder_index, resolution_index, ssimu2_index]
+  all_log_bpp = np.stack([log_bpp for (log_bpp, _) in encoder_curves], axis=1)
+  all_log_nspp = np.stack([log_nspp for (_, log_nspp) in encoder_curves], axis=1)
+
+  # Taking the arithmetic mean in log space is equivalent to taking the
+  # geometric mean of the "true" values
+  return (all_log_bpp.mean(axis=0), all_log_nspp.mean(axis=0))
+
+# Compute the curves for every source for a single encoder, for mean_log_curves().
+# Returns a tuple (log_bpp, log_nspp), each indexed as [source_index, resolution_index, ssimu2_index]
+def encoder_log_curves(database_path, encoder, sources, target_ssimu2_points, num_resolution_points,
+                       interpolation):
+  shape = (len(sources), num_resolution_points+1, len(target_ssimu2_points))
+  log_bpp = np.zeros(shape)
+  log_nspp = np.zeros(shape)
+
+  db = open_database_readonly(database_path)
+  for source_index, source in enumerate(sources):
+    for (resolution_index, source_log_bpp, source_log_nspp) in \
+        interpolate_curves(db, encoder, source, target_ssimu2_points, interpolation):
+      log_bpp[source_index, resolution_index] = source_log_bpp
+      log_nspp[source_index, resolution_index] = source_log_nspp
+  db.close()
+
+  return (log_bpp, log_nspp)
@@ -21,9 +21,10 @@
 # This removes the potential for gnarly data synchronization issues, and they aren't particularly
 # expensive to recompute as-needed, especially compared to the encodes themselves.
 
-import multiprocessing
 import os
 import shlex
+import shutil
+import signal
 import sqlite3
 import subprocess
 import sys
@@ -31,8 +32,7 @@ import time
 
 from argparse import ArgumentParser
 from collections import namedtuple
-from math import *
-from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from tempfile import TemporaryDirectory
 
 from common import *
@@ -63,16 +63,37 @@ QUALITIES = {
 # If the aspect ratio is 16:9, these are 2160p, 1440p, 1080p, 720p, 480p, 360p
 MULTIRES_SIZES = [3840, 2560, 1920, 1280, 853, 640]
 
+# Maximum number of results to collect before writing them to the database
+RESULTS_BATCH_SIZE = 16
+
+# Rough upper bound on the temporary space used by one encode job, in bytes per full-res pixel.
+# Each job can have an uncompressed 16-bit RGB PNG (6 bytes/pixel) of both the decoded and the
+# upscaled image, plus a 12-bit 4:2:0 Y4M (3 bytes/pixel) and the encoded file itself
+TEMP_BYTES_PER_PIXEL = 16
+
 VERBOSE = False
 KEEP_ENCODES = False
 
+# Cache of (width, height) for each source file probed so far. The same file may be listed
+# under several tags (eg. in different source lists), but only needs to be probed once
+IMAGE_SIZES = {}
+
 Encode = namedtuple("Encode", ["resolution_index", "quality"])
 Image = namedtuple("Image", ["basename", "formats", "width", "height"])
 Job = namedtuple("Job", ["job_number", "status_line", "encoder", "source_tag", "fullres_source", "scaled_source", "resolution_index", "quality"])
 
-def run(cmd, **kwargs):
+# Format a command line for display, quoting arguments as the shell would need them
+def format_command(cmd):
+  return " ".join(map(shlex.quote, cmd))
+
+# Echo a command before running it, if in verbose mode.
+# Everything which launches an external tool should go through this
+def log_command(cmd):
   if VERBOSE:
-    print(f"Running `{" ".join(map(shlex.quote, cmd))}`")
+    print(f"Running `{format_command(cmd)}`")
+
+def run(cmd, **kwargs):
+  log_command(cmd)
   return subprocess.run(cmd, check=True, **kwargs)
 
 def parse_args(argv):
@@ -96,6 +117,14 @@ def parse_args(argv):
                       help=f"Print more status messages")
   parser.add_argument("--keep-encodes", action="store_true",
                       help=f"Do not delete encoded/decoded files")
+  parser.add_argument("--temp-dir", default=None,
+                      help="Directory in which to create the temporary directory for encoded/decoded files. "
+                           "Defaults to /dev/shm if it exists and has enough free space for the running jobs, so that "
+                           "these short-lived files don't cause disk I/O, or the system temporary directory otherwise "
+                           "(or if --keep-encodes is set)")
+  parser.add_argument("--cache-dir", default=os.path.join(SCRIPT_DIR, "cache"),
+                      help="Directory in which to keep converted and scaled source images between runs. "
+                           "Defaults to cache/ next to this script file")
 
   parsed_args = parser.parse_args(argv[1:])
 
@@ -104,6 +133,18 @@ def parse_args(argv):
 
   return parsed_args
 
+# Open the results database, configured so that results can be written quickly
+def open_database(path):
+  db = sqlite3.connect(path)
+  # Use write-ahead logging, so that readers and writers don't block each other, and each
+  # commit only has to append to the log rather than going through a rollback journal.
+  # In WAL mode, synchronous=NORMAL still can't corrupt the database; at worst the last few
+  # results are lost on power failure, and those encodes simply get redone on the next run.
+  db.execute("PRAGMA journal_mode=WAL")
+  db.execute("PRAGMA synchronous=NORMAL")
+  db.execute("PRAGMA temp_store=MEMORY")
+  return db
+
 def prepare_database(db):
   db.execute("CREATE TABLE IF NOT EXISTS "
              "sources(source TEXT, resolution_index INT, width INT, height INT)")
@@ -153,10 +194,9 @@ def prepare_source(db, source):
     sizes.append((resolution_index, scaled_width, scaled_height))
     resolution_index += 1
 
-  for (resolution_index, width, height) in sizes:
-    db.execute("INSERT INTO sources VALUES (:source, :index, :width, :height)",
-               {"source": source.tag, "index": resolution_index,
-                "width": width, "height": height})
+  db.executemany("INSERT INTO sources VALUES (?, ?, ?, ?)",
+                 [(source.tag, resolution_index, width, height)
+                  for (resolution_index, width, height) in sizes])
 
   # Commit all resolutions to the database at once
   # This makes sure that, if the above logic is interrupted for any reason, we won't
@@ -166,7 +206,10 @@ def prepare_source(db, source):
 
   return sizes
 
-def convert_to_format(in_path, out_path, format_):
+# Convert an image to one or more of the formats listed in FORMATS.
+# `outputs` maps each format to the path to write it to. All of the outputs are generated
+# by a single ffmpeg process, so that the input only has to be read and decoded once
+def convert_to_formats(in_path, outputs):
   cmd = ["ffmpeg"]
 
   if in_path.endswith(".y4m"):
@@ -180,22 +223,37 @@ def convert_to_format(in_path, out_path, format_):
       "-color_range", "tv",
     ]
 
-  cmd += ["-i", in_path]
+  cmd += [
+    "-i", in_path,
+    "-loglevel", "error", # Suppress log spam
+  ]
+
+  # Output options apply to the next output file listed, so each format gets its own set
+  for format_, out_path in outputs.items():
+    cmd += convert_output_args(format_)
+    cmd += [
+      "-threads", "1",
+      out_path
+    ]
+
+  run(cmd)
 
+# ffmpeg output options needed to generate each format
+def convert_output_args(format_):
   if format_ == "yuv8":
-    cmd += ["-pix_fmt", "yuv420p"]
+    return ["-pix_fmt", "yuv420p"]
   elif format_ == "yuv10":
-    cmd += [
+    return [
       "-pix_fmt", "yuv420p10le",
       "-strict", "-1" # Suppress error message about non-standard format
     ]
   elif format_ == "yuv12":
-    cmd += [
+    return [
       "-pix_fmt", "yuv420p12le",
       "-strict", "-1" # Suppress error message about non-standard format
     ]
   elif format_ == "png8":
-    cmd += [
+    return [
       # Use the zscale filter to do the colourspace conversion
       # This (allegedly) avoids some bugs with the default conversion filter with 10 and 12-bit YUV inputs
       #
@@ -209,7 +267,7 @@ def convert_to_format(in_path, out_path, format_):
       "-update", "1" # Suppress warning about output filename not containing a frame number
     ]
   elif format_ == "png16":
-    cmd += [
+    return [
       # As with png8, we use zscale to avoid bugs. This time we convert to gbrp16le as an intermediate
       # format, followed by an implicit rearrangement to rgb48be for storage in the output PNG
       # Note: The format *must* be little-endian - if we use gbrp16be here, ffmpeg once again takes over
@@ -220,84 +278,166 @@ def convert_to_format(in_path, out_path, format_):
   else:
     raise NotImplementedError(f"Unknown image format {format_}")
 
-  cmd += [
-    "-loglevel", "error", # Suppress log spam
-    "-threads", "1",
-    out_path
-  ]
+# Check whether a cached file generated from `input_path` can be reused: it must exist, and must
+# not be older than its input. Each cached file is compared against the file it was directly
+# converted from, so that regenerating one file also causes everything derived from it to be redone
+def is_cache_fresh(path, input_path):
+  return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(input_path)
 
-  run(cmd)
+# Formats which are generated for every source image we prepare, whether or not any encoder
+# takes them as input: the 12-bit Y4M is the basis for all of the other conversions, and
+# the 16-bit PNG is the reference image for calculating metrics
+ALWAYS_NEEDED_FORMATS = {"yuv12", "png16"}
 
-def prepare_source_images(source, sizes, cachedir):
-  fullres_width, fullres_height = get_image_size(source.path)
+# Generate the requested full-res formats for a source. The full-res size is persisted in the
+# database by prepare_source(), so there's no need to probe the source file again here
+def prepare_fullres_image(source, width, height, formats, cachedir):
+  formats = formats | ALWAYS_NEEDED_FORMATS
 
   # Generate Y4M formats
   # TODO: Detect original file format and avoid duplicating that one?
   # TODO: Handle PNG format inputs properly
-  fullres_formats = {}
-  for format_ in ("yuv8", "yuv10", "yuv12"):
-    converted_path = os.path.join(cachedir, f"{source.tag}.{format_}.y4m")
-    if not os.path.exists(converted_path):
-      convert_to_format(source.path, converted_path, format_)
-    fullres_formats[format_] = converted_path
+  # These are converted in one go, to avoid decoding the (possibly large) source file repeatedly
+  fullres_formats = {format_: os.path.join(cachedir, f"{source.tag}.{format_}.y4m")
+                     for format_ in ("yuv8", "yuv10", "yuv12") if format_ in formats}
+  missing_formats = {format_: path for format_, path in fullres_formats.items()
+                     if not is_cache_fresh(path, source.path)}
+  if missing_formats:
+    convert_to_formats(source.path, missing_formats)
 
   # Now generate PNG formats, converting off of the 12-bit source to minimize rounding errors
+  # Again, these are converted in one go so that the 12-bit source only needs to be read once
+  missing_formats = {}
   for format_ in ("png8", "png16"):
+    if format_ not in formats: continue
+
     converted_path = os.path.join(cachedir, f"{source.tag}.{format_}.png")
-    if not os.path.exists(converted_path):
-      convert_to_format(fullres_formats["yuv12"], converted_path, format_)
+    if not is_cache_fresh(converted_path, fullres_formats["yuv12"]):
+      missing_formats[format_] = converted_path
     fullres_formats[format_] = converted_path
 
-  images = [Image(source.tag, fullres_formats, fullres_width, fullres_height)]
+  if missing_formats:
+    convert_to_formats(fullres_formats["yuv12"], missing_formats)
 
-  for (resolution_index, width, height) in sizes[1:]:
-    assert width < fullres_width and height < fullres_height
+  return Image(source.tag, fullres_formats, width, height)
 
-    scaled_tag = f"{source.tag}_{width}x{height}"
+# Generate the requested formats for one scaled-down version of a source.
+# This only depends on the full-res 12-bit Y4M file, so the different resolutions can be
+# prepared independently of each other
+def prepare_scaled_image(source, fullres_image, width, height, formats, cachedir):
+  assert width < fullres_image.width and height < fullres_image.height
 
-    scaled_formats = {}
+  formats = formats | ALWAYS_NEEDED_FORMATS
 
-    # Use 12-bit Y4M for initial scaling, to minimize rounding error
-    scaled_yuv12_path = os.path.join(cachedir, f"{scaled_tag}.yuv12.y4m")
-    if not os.path.exists(scaled_yuv12_path):
-      run(["ffmpeg", "-i", fullres_formats["yuv12"],
-           "-vf", f"zscale={width}:{height}:filter=lanczos",
-           "-loglevel", "error", # Suppress log spam
-           "-strict", "-1", # Prevent error when scaling 10-bit files
-           scaled_yuv12_path])
-    scaled_formats["yuv12"] = scaled_yuv12_path
+  scaled_tag = f"{source.tag}_{width}x{height}"
+
+  scaled_formats = {}
 
-    # Then convert to all of the other formats we need
-    for format_ in FORMATS:
-      if format_ == "yuv12": continue
+  # Use 12-bit Y4M for initial scaling, to minimize rounding error
+  scaled_yuv12_path = os.path.join(cachedir, f"{scaled_tag}.yuv12.y4m")
+  if not is_cache_fresh(scaled_yuv12_path, fullres_image.formats["yuv12"]):
+    run(["ffmpeg", "-i", fullres_image.formats["yuv12"],
+         "-vf", f"zscale={width}:{height}:filter=lanczos",
+         "-loglevel", "error", # Suppress log spam
+         "-strict", "-1", # Prevent error when scaling 10-bit files
+         "-threads", "1",
+         scaled_yuv12_path])
+  scaled_formats["yuv12"] = scaled_yuv12_path
+
+  # Then convert to all of the other formats we need, using a single ffmpeg process
+  # so that the scaled image only needs to be read once
+  missing_formats = {}
+  for format_ in formats:
+    if format_ == "yuv12": continue
 
-      ext = "png" if format_.startswith("png") else "y4m"
-      converted_path = os.path.join(cachedir, f"{scaled_tag}.{format_}.{ext}")
-      if not os.path.exists(converted_path):
-        convert_to_format(scaled_yuv12_path, converted_path, format_)
-      scaled_formats[format_] = converted_path
+    ext = "png" if format_.startswith("png") else "y4m"
+    converted_path = os.path.join(cachedir, f"{scaled_tag}.{format_}.{ext}")
+    if not is_cache_fresh(converted_path, scaled_yuv12_path):
+      missing_formats[format_] = converted_path
+    scaled_formats[format_] = converted_path
 
-    images.append(Image(scaled_tag, scaled_formats, width, height))
+  if missing_formats:
+    convert_to_formats(scaled_yuv12_path, missing_formats)
 
-  return images
+  return Image(scaled_tag, scaled_formats, width, height)
 
 def get_image_size(path):
-  width=None
-  height=None
-  ffprobe_result = run(["ffprobe", "-hide_banner", "-show_streams", path],
+  if path not in IMAGE_SIZES:
+    IMAGE_SIZES[path] = get_image_size_uncached(path)
+  return IMAGE_SIZES[path]
+
+def get_image_size_uncached(path):
+  if path.endswith(".y4m"):
+    return get_y4m_size(path)
+
+  # Ask ffprobe for just the width and height of the first video stream,
+  # which it prints as a single "width,height" line
+  ffprobe_result = run(["ffprobe", "-v", "error",
+                        "-select_streams", "v:0",
+                        "-show_entries", "stream=width,height",
+                        "-of", "csv=p=0",
+                        path],
                        capture_output=True)
-  for line in ffprobe_result.stdout.split(b"\n"):
-    if line.startswith(b"width="):
-      width = int(line[6:])
-    elif line.startswith(b"height="):
-      height = int(line[7:])
+  (width, height) = map(int, ffprobe_result.stdout.strip().split(b","))
+  return (width, height)
+
+# Y4M files start with a plain-text header line, of the form "YUV4MPEG2 W<width> H<height> ...",
+# so we can read the size directly rather than launching ffprobe
+def get_y4m_size(path):
+  with open(path, "rb") as f:
+    header = f.readline()
+
+  fields = header.split()
+  if len(fields) == 0 or fields[0] != b"YUV4MPEG2":
+    print_error(f"{path}: Not a valid Y4M file")
+    sys.exit(1)
+
+  width = None
+  height = None
+  for field in fields[1:]:
+    if field.startswith(b"W"):
+      width = int(field[1:])
+    elif field.startswith(b"H"):
+      height = int(field[1:])
+
+  if width is None or height is None:
+    print_error(f"{path}: Y4M header does not specify the image size")
+    sys.exit(1)
 
-  assert width is not None and height is not None
   return (width, height)
 
+# Run one of the libjxl metrics tools on a pair of images, and return the score.
+# Both tools print their main score as the first thing in their output, so we only need
+# the first whitespace-separated token of the first non-blank line.
+# The rest of the output is read and discarded line by line, so that the tool can't block
+# on a full pipe, without holding its whole output in memory. Diagnostics on stderr are
+# discarded too, so that they don't get mixed in with the progress output
+def run_metric(tool_path, reference_path, distorted_path):
+  cmd = [tool_path, reference_path, distorted_path]
+  log_command(cmd)
+
+  score = None
+  with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as proc:
+    for line in proc.stdout:
+      if score is None and not line.isspace():
+        score = line.split(maxsplit=1)[0]
+    returncode = proc.wait()
+
+  if returncode != 0:
+    raise subprocess.CalledProcessError(returncode=returncode, cmd=cmd)
+
+  if score is None:
+    raise ValueError(f"`{format_command(cmd)}` did not output a score")
+
+  return float(score)
+
 # Function to handle a single encode (one encoder, one resolution, one quality value).
 # This function is run in parallel when the `--jobs` argument is greater than 1
-def run_encode(db, job, build_root, tmpdir):
+# Returns a tuple of results, in the same column order as the results table
+#
+# Every temporary file this function creates is appended to `temp_paths` as soon as its
+# name is known, so that the caller can clean up even if the encode fails part-way through
+def run_encode(job, build_root, tmpdir, temp_paths):
   encoder = job.encoder
   fullres_source = job.fullres_source
   scaled_source = job.scaled_source
@@ -305,57 +445,61 @@ def run_encode(db, job, build_root, tmpdir):
 
   input_path = scaled_source.formats[encoder.format]
 
+  # All of the files generated for this job share a common path prefix,
+  # and differ only by suffix and extension
+  output_prefix = os.path.join(tmpdir, encoder.tag, f"{scaled_source.basename}_q{quality}")
+
   # Build command line
   if encoder.encoder == "tinyavif":
-    compressed_path = os.path.join(tmpdir, encoder.tag, f"{scaled_source.basename}_q{quality}.avif")
+    compressed_path = f"{output_prefix}.avif"
     tinyavif_path = os.path.join(build_root, "tinyavif", "release", "tinyavif")
     cmd = [tinyavif_path,
            input_path, "-o", compressed_path,
            "--qindex", str(255 - quality)
           ]
   elif encoder.encoder == "aom":
-    compressed_path = os.path.join(tmpdir, encoder.tag, f"{scaled_source.basename}_q{quality}.avif")
+    compressed_path = f"{output_prefix}.avif"
     cmd = ["avifenc",
            input_path, "-o", compressed_path,
            "-c", "aom", "-s", str(encoder.settings["speed"]),
-           "-j", "1",
+           "-j", str(encoder.settings["threads"]),
            "-q", str(quality)
           ]
     if encoder.settings["tune"] is not None:
       cmd += ["-a", f"tune={encoder.settings["tune"]}"]
   elif encoder.encoder == "svt":
-    compressed_path = os.path.join(tmpdir, encoder.tag, f"{scaled_source.basename}_q{quality}.avif")
+    compressed_path = f"{output_prefix}.avif"
     cmd = ["avifenc",
            input_path, "-o", compressed_path,
            "-c", "svt", "-s", str(encoder.settings["speed"]),
-           "-j", "1",
+           "-j", str(encoder.settings["threads"]),
            "-q", str(quality)
           ]
     if encoder.settings["tune"] is not None:
       cmd += ["-a", f"tune={encoder.settings["tune"]}"]
   elif encoder.encoder == "rav1e":
-    compressed_path = os.path.join(tmpdir, encoder.tag, f"{scaled_source.basename}_q{quality}.avif")
+    compressed_path = f"{output_prefix}.avif"
     cmd = ["avifenc",
            input_path, "-o", compressed_path,
            "-c", "rav1e", "-s", str(encoder.settings["speed"]),
-           "-j", "1",
+           "-j", str(encoder.settings["threads"]),
            "-q", str(quality)
           ]
   elif encoder.encoder == "jpegli":
-    compressed_path = os.path.join(tmpdir, encoder.tag, f"{scaled_source.basename}_q{quality}.jpeg")
+    compressed_path = f"{output_prefix}.jpeg"
     cmd = ["cjpegli",
            input_path, compressed_path,
            "-q", str(quality)
           ]
   elif encoder.encoder == "jpegxl":
-    compressed_path = os.path.join(tmpdir, encoder.tag, f"{scaled_source.basename}_q{quality}.jxl")
+    compressed_path = f"{output_prefix}.jxl"
     cmd = ["cjxl", "-e", str(encoder.settings["effort"]),
            input_path, compressed_path,
-           "--num_threads", "1",
+           "--num_threads", str(encoder.settings["threads"]),
            "-q", str(quality)
           ]
   elif encoder.encoder == "webp":
-    compressed_path = os.path.join(tmpdir, encoder.tag, f"{scaled_source.basename}_q{quality}.webp")
+    compressed_path = f"{output_prefix}.webp"
     cmd = ["cwebp",
            "-preset", encoder.settings["preset"],
            "-m", str(encoder.settings["effort"]),
@@ -364,7 +508,7 @@ def run_encode(db, job, build_root, tmpdir):
           ]
   elif encoder.encoder == "webp_nll":
     # Similar to jpegli, webp can currently only accept 4:4:4 inputs
-    compressed_path = os.path.join(tmpdir, encoder.tag, f"{scaled_source.basename}_q{quality}.webp")
+    compressed_path = f"{output_prefix}.webp"
     cmd = ["cwebp",
            "-preset", encoder.settings["preset"],
            "-z", str(encoder.settings["effort"]),
@@ -374,6 +518,8 @@ def run_encode(db, job, build_root, tmpdir):
   else:
     raise NotImplemented
 
+  temp_paths.append(compressed_path)
+
   # Do the encode and gather stats
   # Note: In order to gather detailed resource usage information, we need to use the `wait4()`
   # system call. Unfortunately, the subprocess module doesn't expose that in a nice way,
@@ -403,8 +549,9 @@ def run_encode(db, job, build_root, tmpdir):
   mem_peak = rusage.ru_maxrss
 
   # Convert output to a PNG for metrics calculation
-  compressed_png_path = os.path.join(tmpdir, encoder.tag, f"{scaled_source.basename}_q{quality}.png16.png")
+  compressed_png_path = f"{output_prefix}.png16.png"
   compressed_y4m_path = None
+  temp_paths.append(compressed_png_path)
 
   if encoder.format.startswith("png"):
     # Assume that the image decodes directly to a 16-bit PNG
@@ -412,6 +559,7 @@ def run_encode(db, job, build_root, tmpdir):
          "-pix_fmt", "rgb48be",
          "-loglevel", "error", # Suppress log spam
          "-update", "1", # Suppress warning about output filename not containing a frame number
+         "-compression_level", "0", # Temporary file, so don't spend time compressing it
          "-threads", "1",
          compressed_png_path])
   else:
@@ -419,11 +567,13 @@ def run_encode(db, job, build_root, tmpdir):
     # For some reason, passing the AVIF input directly here breaks with a message about
     # how there is "no path between colorspaces". Yet decoding to a Y4M file first bypasses
     # this. (???)
-    compressed_y4m_path = os.path.join(tmpdir, encoder.tag, f"{scaled_source.basename}_q{quality}.y4m")
+    compressed_y4m_path = f"{output_prefix}.y4m"
+    temp_paths.append(compressed_y4m_path)
     run(["ffmpeg",
          "-i", compressed_path,
          "-loglevel", "error", # Suppress log spam
          "-strict", "-1", # Suppress error message about non-standard format
+         "-threads", "1",
          compressed_y4m_path])
     run(["ffmpeg",
          # Set colourspace info, in case the compressed file doesn't do this
@@ -438,25 +588,20 @@ def run_encode(db, job, build_root, tmpdir):
          "-vf", f"format=yuv420p12le,zscale=filter=lanczos,format=gbrp16le",
          "-loglevel", "error", # Suppress log spam
          "-update", "1", # Suppress warning about output filename not containing a frame number
+         "-compression_level", "0", # Temporary file, so don't spend time compressing it
          "-threads", "1",
          compressed_png_path])
 
   # Compute same-res SSIMULACRA2 score
   # We expect the output from this command to be a single line containing the SSIMU2 score
   ssimu2_path = os.path.join(build_root, "libjxl", "tools", "ssimulacra2")
-  sameres_ssimu2_proc = run([ssimu2_path, scaled_source.formats["png16"], compressed_png_path], capture_output=True)
-  line = sameres_ssimu2_proc.stdout.strip().split(b"\n", maxsplit=1)[0]
-  sameres_ssimu2 = float(line)
+  sameres_ssimu2 = run_metric(ssimu2_path, scaled_source.formats["png16"], compressed_png_path)
 
   # Then compute Butteraugli score
   # This time the output consists of two lines with different metrics, but for now we just use the main score
   # (which is printed by itself on the first output line)
   butteraugli_path = os.path.join(build_root, "libjxl", "tools", "butteraugli_main")
-  sameres_butteraugli_proc = run([butteraugli_path, scaled_source.formats["png16"], compressed_png_path], capture_output=True)
-  line = sameres_butteraugli_proc.stdout.strip().split(b"\n", maxsplit=1)[0]
-  sameres_butteraugli = float(line)
-
-  upscaled_png_path = None
+  sameres_butteraugli = run_metric(butteraugli_path, scaled_source.formats["png16"], compressed_png_path)
 
   if scaled_source is fullres_source:
     # No need to compute SSIMU2 score twice
@@ -464,7 +609,8 @@ def run_encode(db, job, build_root, tmpdir):
     fullres_butteraugli = sameres_butteraugli
   else:
     # Compute full-res SSIMU2 score
-    upscaled_png_path = os.path.join(tmpdir, encoder.tag, f"{scaled_source.basename}_q{quality}_upscaled.png16.png")
+    upscaled_png_path = f"{output_prefix}_upscaled.png16.png"
+    temp_paths.append(upscaled_png_path)
 
     if encoder.format.startswith("png"):
       # Assume that the image decodes to a 16-bit PNG
@@ -477,6 +623,7 @@ def run_encode(db, job, build_root, tmpdir):
            "-vf", f"zscale={fullres_source.width}:{fullres_source.height}:filter=lanczos",
            "-loglevel", "error", # Suppress log spam
            "-update", "1", # Suppress warning about output filename not containing a frame number
+           "-compression_level", "0", # Temporary file, so don't spend time compressing it
            "-threads", "1",
            upscaled_png_path])
     else:
@@ -494,55 +641,100 @@ def run_encode(db, job, build_root, tmpdir):
            "-vf", f"zscale={fullres_source.width}:{fullres_source.height}:filter=lanczos",
            "-loglevel", "error", # Suppress log spam
            "-update", "1", # Suppress warning about output filename not containing a frame number
+           "-compression_level", "0", # Temporary file, so don't spend time compressing it
            "-threads", "1",
            upscaled_png_path])
 
-    fullres_ssimu2_proc = run([ssimu2_path, fullres_source.formats["png16"], upscaled_png_path], capture_output=True)
-    line = fullres_ssimu2_proc.stdout.strip().split(b"\n", maxsplit=1)[0]
-    fullres_ssimu2 = float(line)
-
-    fullres_butteraugli_proc = run([butteraugli_path, fullres_source.formats["png16"], upscaled_png_path], capture_output=True)
-    line = fullres_butteraugli_proc.stdout.strip().split(b"\n", maxsplit=1)[0]
-    fullres_butteraugli = float(line)
-
-  # Clean up after ourselves
-  if not KEEP_ENCODES:
-    if compressed_y4m_path is not None:
-      os.remove(compressed_y4m_path)
-    os.remove(compressed_png_path)
-    if upscaled_png_path is not None:
-      os.remove(upscaled_png_path)
-    os.remove(compressed_path)
-
-  db.execute(
-    "INSERT INTO results VALUES (:encoder, :source, :resolution_index, :quality, :size, "
-                                ":real_runtime, :user_runtime, :sys_runtime, :mem_peak, "
-                                ":ssimu2, :butteraugli, :fullres_ssimu2, :fullres_butteraugli)",
-     {
-      "encoder": job.encoder.tag, "source": job.source_tag,
-      "resolution_index": job.resolution_index, "quality": job.quality,
-      "size": size, "real_runtime": real_runtime, "user_runtime": user_runtime,
-      "sys_runtime": sys_runtime, "mem_peak": mem_peak,
-      "ssimu2": sameres_ssimu2, "butteraugli": sameres_butteraugli,
-      "fullres_ssimu2": fullres_ssimu2, "fullres_butteraugli": fullres_butteraugli
-     }
+    fullres_ssimu2 = run_metric(ssimu2_path, fullres_source.formats["png16"], upscaled_png_path)
+    fullres_butteraugli = run_metric(butteraugli_path, fullres_source.formats["png16"], upscaled_png_path)
+
+  return (
+    job.encoder.tag, job.source_tag, job.resolution_index, job.quality,
+    size, real_runtime, user_runtime, sys_runtime, mem_peak,
+    sameres_ssimu2, sameres_butteraugli, fullres_ssimu2, fullres_butteraugli
   )
-  db.commit()
 
-def worker_main(db, build_root, tmpdir, queue):
-  while 1:
-    job = queue.get()
+# Insert a list of results, as returned by run_encode(), into the database in one transaction.
+# The list is cleared afterwards
+#
+# If the batch can't be inserted as a whole (eg. because one result clashes with an existing row),
+# fall back to inserting the results one at a time, so that only the bad results are lost.
+# These are reported in the same way as failed jobs, rather than stopping the whole run
+def write_results(db, results):
+  if len(results) == 0:
+    return
+
+  query = "INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+  try:
+    db.executemany(query, results)
+    db.commit()
+  except sqlite3.Error:
+    db.rollback()
+    for result in results:
+      try:
+        db.execute(query, result)
+      except sqlite3.Error as e:
+        encoder_tag, source_tag, resolution_index, quality = result[:4]
+        print(f"Failed to write result for encoder {encoder_tag}, source {source_tag}, "
+              f"resolution index {resolution_index}, quality {quality}: {e}")
+    db.commit()
+  results.clear()
+
+# Choose where to create the temporary directory for encoded/decoded files, if --temp-dir isn't given.
+# Returns None to use the system default.
+#
+# We prefer a RAM-backed location, so that these short-lived files don't cause disk I/O. But /dev/shm
+# is often small (eg. 64MiB by default in Docker containers), so only use it if it has room for
+# every job that can be running at once
+def choose_temp_dir(source_sizes, num_workers):
+  if KEEP_ENCODES or not os.path.isdir("/dev/shm"):
+    # If the files are being kept, leave them on disk instead, as they'd otherwise take up
+    # memory until the next reboot
+    return None
+
+  max_num_pixels = max((sizes[0][1] * sizes[0][2] for sizes in source_sizes.values()), default=0)
+  space_needed = max_num_pixels * TEMP_BYTES_PER_PIXEL * num_workers
+  space_free = shutil.disk_usage("/dev/shm").free
+  if space_free < space_needed:
+    if VERBOSE:
+      print(f"Not using /dev/shm for temporary files: {space_free >> 20} MiB free, "
+            f"up to {space_needed >> 20} MiB needed")
+    return None
+
+  return "/dev/shm"
+
+# Set up each encode worker process. The global settings are passed in explicitly, as they
+# aren't inherited if the worker processes are spawned rather than forked.
+#
+# Ctrl-C is delivered to the workers as well as to the main process. Rather than each worker
+# raising KeyboardInterrupt (and then picking up its next queued job), let the default action
+# end the worker straight away, just as it does for the encoders the worker is running
+def init_worker(verbose, keep_encodes):
+  global VERBOSE
+  global KEEP_ENCODES
 
-    try:
-      print(job.status_line)
-      run_encode(db, job, build_root, tmpdir)
-    except Exception as e:
-      print(f"Job {job.job_number} failed: {e}")
-    finally:
-      # Always mark tasks as done, even if they fail, so that the main process
-      # doesn't get blocked waiting on us
-      queue.task_done()
+  VERBOSE = verbose
+  KEEP_ENCODES = keep_encodes
+  signal.signal(signal.SIGINT, signal.SIG_DFL)
 
+# Function run in the worker processes: run a single job and return its results, or None if it failed.
+# Failures are reported here, but don't stop the remaining jobs from running
+#
+# The job's temporary files are removed whether or not it succeeded, so that failed jobs
+# don't leave partial outputs lying around in the temporary directory
+def run_job(job, build_root, tmpdir):
+  temp_paths = []
+  try:
+    print(job.status_line)
+    return run_encode(job, build_root, tmpdir, temp_paths)
+  except Exception as e:
+    print(f"Job {job.job_number} failed: {e}")
+    return None
+  finally:
+    if not KEEP_ENCODES:
+      for path in temp_paths:
+        if os.path.exists(path):
+          os.remove(path)
 
 def main(argv):
   arguments = parse_args(argv)
@@ -550,73 +742,132 @@ def main(argv):
   encoders = flatten(load_encoder_list(encoder) for encoder in arguments.encoder_lists)
   sources = flatten(load_source_list(source) for source in arguments.source_lists)
 
-  db = sqlite3.connect(arguments.database)
+  db = open_database(arguments.database)
 
   prepare_database(db)
 
-  tmpdir = TemporaryDirectory(delete=(not KEEP_ENCODES))
-
-  if KEEP_ENCODES:
-    print(f"Writing encoded files to {tmpdir.name}")
-
-  cachedir = os.path.join(SCRIPT_DIR, "cache")
+  cachedir = arguments.cache_dir
   os.makedirs(cachedir, mode=0o755, exist_ok=True)
   add_cache_tag(cachedir)
 
-  # Prepare worker processes
-  task_queue = multiprocessing.JoinableQueue()
-
   if arguments.jobs is None:
     num_workers = os.process_cpu_count()
   else:
     num_workers = arguments.jobs
 
-  workers = []
-  for _ in range(num_workers):
-    worker = multiprocessing.Process(target=worker_main, args=(db, arguments.build_root, tmpdir.name, task_queue))
-    worker.start()
-    workers.append(worker)
-
   # Scale sources if required
-  # TODO: Parallelize
+  # The database work here is cheap, so do that up-front. This includes working out exactly which
+  # source images we need: which resolutions of each source still have encodes left to do, and which
+  # input formats those encodes use. Then we only generate those images.
   print("Preparing source images...")
+  source_sizes = {source.tag: prepare_source(db, source) for source in sources}
+
+  # Now that the source sizes are known, set up the temporary directory for the encodes
+  temp_dir = arguments.temp_dir
+  if temp_dir is None:
+    temp_dir = choose_temp_dir(source_sizes, num_workers)
+
+  tmpdir = TemporaryDirectory(dir=temp_dir, delete=(not KEEP_ENCODES))
+
+  if KEEP_ENCODES:
+    print(f"Writing encoded files to {tmpdir.name}")
+
+  query = db.execute("SELECT encoder, source, resolution_index, quality FROM results")
+  encodes_done = set(query.fetchall())
+
+  # needed_formats[source tag][resolution index] = set of formats
+  needed_formats = {source.tag: {} for source in sources}
+  for encoder in encoders:
+    for source in sources:
+      for (resolution_index, _, _) in source_sizes[source.tag]:
+        if any((encoder.tag, source.tag, resolution_index, quality) not in encodes_done
+               for quality in QUALITIES[encoder.encoder]):
+          needed_formats[source.tag].setdefault(resolution_index, set()).add(encoder.format)
+
+  # The actual image conversions are run in parallel. Threads are fine here, as each one spends
+  # almost all of its time waiting on ffmpeg subprocesses.
+  #
+  # Each source's full-res formats are prepared first, as one task per source. As soon as
+  # one of those finishes, that source's scaled resolutions are queued as separate tasks,
+  # so that even a single large source can make use of multiple cores.
+  #
+  # The full-res image is always needed if there is anything left to do for a source,
+  # as it's the reference for the full-res metrics
   source_images = {}
-  for source in sources:
-    sizes = prepare_source(db, source)
-    source_images[source.tag] = prepare_source_images(source, sizes, cachedir)
+  scaled_futures = {}
+  with ThreadPoolExecutor(max_workers=num_workers) as executor:
+    fullres_futures = {}
+    for source in sources:
+      this_source_formats = needed_formats[source.tag]
+      if not this_source_formats:
+        # All encodes for this source have already been done
+        continue
+
+      (_, fullres_width, fullres_height) = source_sizes[source.tag][0]
+      future = executor.submit(prepare_fullres_image, source, fullres_width, fullres_height,
+                               this_source_formats.get(0, set()), cachedir)
+      fullres_futures[future] = source
+
+    for future in as_completed(fullres_futures):
+      source = fullres_futures[future]
+      this_source_formats = needed_formats[source.tag]
+      fullres_image = future.result()
+      source_images[source.tag] = {0: fullres_image}
+      scaled_futures[source.tag] = {
+        resolution_index: executor.submit(prepare_scaled_image, source, fullres_image, width, height,
+                                          this_source_formats[resolution_index], cachedir)
+        for (resolution_index, width, height) in source_sizes[source.tag][1:]
+        if resolution_index in this_source_formats
+      }
+
+  for tag, futures in scaled_futures.items():
+    for resolution_index, future in futures.items():
+      source_images[tag][resolution_index] = future.result()
 
   # Now run the encodes
   # We break up the jobs per encoder, waiting for all jobs using one encoder setup to finish
   # before starting the next. This helps to improve the reproducibility of our runtime numbers.
+  #
+  # The jobs run in a pool of worker processes, each running one job at a time. Each job times its
+  # encode from its own process, so the timings don't pick up any delay from waiting on other jobs
+  # (as they would with a thread pool, where a thread must reacquire the GIL after its encoder exits).
+  # The workers only run the encodes and hand their results back. All database writes happen here
+  # in the main process, in batches, so that there's only ever one writer.
+  #
+  # Some encoders can be configured to use multiple threads per encode. In that case we run
+  # proportionally fewer encodes at once, so that the machine isn't oversubscribed.
   num_encoders = len(encoders)
   for encoder_index, encoder in enumerate(encoders):
+    threads_per_encode = int(encoder.settings.get("threads", 1))
+    num_encoder_workers = max(1, num_workers // threads_per_encode)
+
     os.makedirs(os.path.join(tmpdir.name, encoder.tag), mode=0o755, exist_ok=True)
 
     # Prepare job list
     partial_jobs = []
     for source in sources:
-      # Check which encodes have already been done for this source
-      query = db.execute("SELECT resolution_index, quality FROM results "
-                         "WHERE encoder = :encoder AND source = :source",
-                         {"encoder": encoder.tag, "source": source.tag})
-      encodes_done = set(query.fetchall())
+      if source.tag not in source_images:
+        # Nothing left to do for this source
+        continue
 
       this_source_images = source_images[source.tag]
       fullres_image = this_source_images[0]
 
-      for resolution_index, scaled_image in enumerate(this_source_images):
+      for resolution_index, scaled_image in this_source_images.items():
         for quality in QUALITIES[encoder.encoder]:
-          if (resolution_index, quality) in encodes_done:
+          if (encoder.tag, source.tag, resolution_index, quality) in encodes_done:
             continue
 
           partial_jobs.append((encoder, source.tag, fullres_image, scaled_image, resolution_index, quality))
 
     # Sort encodes so that we launch the higher-resolution (lower resolution index)
     # and higher-quality (higher `quality` parameter) first. This helps reduce the
-    # tail latency of the batch of encodes
+    # tail latency of the batch of encodes.
+    # Within each resolution, all of the encodes for one source are kept together, so that
+    # the reference images used for metric calculation stay in the OS page cache
     def sort_key(partial_job):
-      _, _, _, _, resolution_index, quality = partial_job
-      return (resolution_index, -quality)
+      _, source_tag, _, _, resolution_index, quality = partial_job
+      return (resolution_index, source_tag, -quality)
     partial_jobs.sort(key = sort_key)
 
     # Fill in status lines for jobs
@@ -628,18 +879,40 @@ def main(argv):
                     f"Encode {source_tag} at resolution {scaled_image.width:4}x{scaled_image.height:4}, quality {quality:3}"
       jobs.append(Job(job_index+1, status_line, encoder, source_tag, fullres_image, scaled_image, resolution_index, quality))
 
-    # Now enqueue all the jobs. This will happen in parallel with some of the jobs executing,
-    # so we want to do as little work as possible here to minimize interference with job execution.
-    for job in jobs:
-      task_queue.put(job)
-
-    # Wait for this batch to finish before moving on
-    task_queue.join()
+    # Now run all the jobs, collecting results as they complete. Jobs are started in the order
+    # sorted above. This loop only finishes once all of this encoder's jobs are done.
+    pending_results = []
+    executor = ProcessPoolExecutor(max_workers=num_encoder_workers, initializer=init_worker,
+                                   initargs=(VERBOSE, KEEP_ENCODES))
+    futures = [executor.submit(run_job, job, arguments.build_root, tmpdir.name) for job in jobs]
+    unfinished = set(futures)
+    try:
+      for future in as_completed(futures):
+        unfinished.remove(future)
+        result = future.result()
+        if result is not None:
+          pending_results.append(result)
+        if len(pending_results) >= RESULTS_BATCH_SIZE:
+          write_results(db, pending_results)
+      executor.shutdown()
+    except BaseException:
+      # If the run is interrupted (eg. by Ctrl-C, which also ends the workers), or anything else
+      # goes wrong, cancel all of the jobs which haven't started yet
+      executor.shutdown(cancel_futures=True)
+
+      # Then pick up the results of any jobs which finished before the pool shut down
+      for future in unfinished:
+        if not future.cancelled() and future.exception() is None:
+          result = future.result()
+          if result is not None:
+            pending_results.append(result)
+      raise
+    finally:
+      # Write out everything collected so far, including when the run is stopped early.
+      # Jobs which hadn't finished by then are simply run again next time
+      write_results(db, pending_results)
 
   # Clean up
-  for worker in workers:
-    worker.terminate()
-
   db.close()
 
   print("Done")
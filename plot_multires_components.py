@@ -7,15 +7,15 @@
 # was not distributed with this source code in the LICENSE file, you can obtain it at
 # https://opensource.org/license/bsd-2-clause
 
-import matplotlib.pyplot as plt
 import numpy as np
 import os
-import sqlite3
 import sys
 
 from argparse import ArgumentParser
-from math import *
+from concurrent.futures import ThreadPoolExecutor
 from matplotlib import ticker
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 
 from common import *
 
@@ -35,6 +35,8 @@ def parse_args(argv):
                       default=None)
   parser.add_argument("--step", help=f"SSIMU2 step size used for interpolation, default {DEFAULT_SSIMU2_STEP}",
                       type=float, default=DEFAULT_SSIMU2_STEP)
+  parser.add_argument("--interp", choices=INTERPOLATION_METHODS, default=DEFAULT_INTERPOLATION,
+                      help=f"Method used to interpolate between data points, default {DEFAULT_INTERPOLATION}")
   parser.add_argument("encoder_tag", help="Single encoder to plot. This must be one of the entries in the specified encoder list")
   parser.add_argument("source_tag", help="Single source image to plot. This must be one of the entries in the specified source list")
 
@@ -45,7 +47,8 @@ def parse_args(argv):
   return arguments
 
 # For this script we need to interpolate the curves differently to the other scripts,
-# so use a custom interpolation function
+# so use a custom interpolation function which keeps the individual full-res curves
+# instead of merging them into a multires curve
 #
 # Each curve may span a different subset of SSIMU2 scores, so we return those per-curve
 # alongside the log(bpp) and log(nspp) data.
@@ -57,93 +60,43 @@ def parse_args(argv):
 # * log_nspp[resolution_index][data_index]
 #
 # Note that the number of data points may be different per curve.
-def interpolate_fullres_curves(db, encoder, source, target_ssimu2_points):
+def interpolate_fullres_curves(db, encoder, source, target_ssimu2_points, interpolation):
   ssimu2_points = []
   log_bpp = []
   log_nspp = []
 
-  resolutions = db.execute("SELECT resolution_index, width, height FROM sources WHERE source = :source;",
-                           {"source": source.tag}).fetchall()
-  resolutions.sort()
-  num_resolutions = len(resolutions)
+  resolutions = get_source_resolutions(db, source)
 
   fullres_width = resolutions[0][1]
   fullres_height = resolutions[0][2]
   fullres_num_pixels = fullres_width * fullres_height
 
-  for (resolution_index, width, height) in resolutions:
-    num_pixels = width * height
+  # Fetch results sorted by fullres score within each resolution
+  all_results = load_results(db, encoder, source, resolutions, "fullres_ssimu2")
 
-    query = db.execute("SELECT size, real_runtime, user_runtime, sys_runtime, mem_peak, "
-                       "ssimu2, butteraugli, fullres_ssimu2, fullres_butteraugli FROM results "
-                       "WHERE encoder = :encoder AND source = :source AND resolution_index = :resolution_index;",
-                       {"encoder": encoder.tag, "source": source.tag, "resolution_index": resolution_index})
-
-    # Map result rows to a proper object
-    query.row_factory = lambda _, row: EncodeData._make(row)
-    results = query.fetchall()
-
-    num_points = len(results)
-    if num_points == 0:
+  for results in all_results:
+    if len(results.size) == 0:
       print_error(f"No encodes found for encoder {encoder.tag} and source {source.tag}")
       sys.exit(1)
 
-    # Sort results based on fullres score
-    results.sort(key = lambda row: row.fullres_ssimu2)
-
-    fullres_log_bpp_points = np.zeros(num_points)
-    fullres_log_nspp_points = np.zeros(num_points)
-    fullres_ssimu2_points = np.zeros(num_points)
-    for row_index, row in enumerate(results):
-      fullres_log_bpp_points[row_index] = log(row.size * 8.0 / fullres_num_pixels)
-      fullres_log_nspp_points[row_index] = log(row.real_runtime * 1000000000.0 / fullres_num_pixels)
-      fullres_ssimu2_points[row_index] = row.fullres_ssimu2
-
-    # We might not necessarily have enough data to cover the full target SSIMU2 range.
-    # This is okay, we just need to filter the curve so that we have appropriate data
-    min_fullres_ssimu2 = results[0].fullres_ssimu2
-    max_fullres_ssimu2 = results[-1].fullres_ssimu2
-
-    fullres_target_ssimu2_points = []
-    for index, target_ssimu2 in enumerate(target_ssimu2_points):
-      if min_fullres_ssimu2 <= target_ssimu2 <= max_fullres_ssimu2:
-        fullres_target_ssimu2_points.append(target_ssimu2)
-
-    # ...and merge fullres curve into multires curve
-    fullres_log_bpp = pchip_interpolate(fullres_ssimu2_points, fullres_log_bpp_points, fullres_target_ssimu2_points)
-    fullres_log_nspp = pchip_interpolate(fullres_ssimu2_points, fullres_log_nspp_points, fullres_target_ssimu2_points)
-    
-    ssimu2_points.append(fullres_target_ssimu2_points)
+    fullres_range, fullres_log_bpp, fullres_log_nspp = \
+      interpolate_fullres_curve(results, fullres_num_pixels, target_ssimu2_points, interpolation)
+
+    ssimu2_points.append(target_ssimu2_points[fullres_range])
     log_bpp.append(fullres_log_bpp)
     log_nspp.append(fullres_log_nspp)
 
   return (ssimu2_points, log_bpp, log_nspp)
 
-# Custom function to format the log scale ticks nicely
-# Based on https://stackoverflow.com/a/17209836
 def format_tick(value, _):
-  exp = int(floor(log10(value)))
-  base = int(round(value / 10**exp))
-
-  # Skip labelling the 5, 7, and 9 subdivisions to avoid crowding.
-  # These skipped subdivisions still get a tick mark on the axis to indicate
-  # where they are
-  if base in (5, 7, 9): return ""
-
-  if exp >= 1:
-    return f"{value:.0f}"
-  elif exp == 0:
-    # In this case the tick values are single-digit integers,
-    # but add a decimal place anyway because 0.6, 0.8, 1.0, 2.0, ... looks prettier
-    # than 0.6, 0.8, 1, 2, ...
-    return f"{value:.1f}"
-  else:
-    # For values < 1, display with the minimal number of decimal places
-    fmt = f"%.{-exp:d}f"
-    return fmt % value
+  return format_log_tick(value)
 
 def plot(title, metric_label, resolution_labels, ssimu2_points, log_metric, filename):
-  fig, ax = plt.subplots()
+  # Use the object-oriented matplotlib API rather than pyplot, so that there's no shared
+  # global state and multiple plots can be generated in parallel
+  fig = Figure()
+  FigureCanvasAgg(fig)
+  ax = fig.subplots()
   ax.set(xlabel=metric_label, ylabel="SSIMU2")
   ax.set_title(title)
 
@@ -161,16 +114,18 @@ def plot(title, metric_label, resolution_labels, ssimu2_points, log_metric, file
   ax.xaxis.set_minor_formatter(ticker.FuncFormatter(format_tick))
 
   ax.tick_params(axis="x", which="major", labelsize="small")
-  plt.xticks(minor=False, rotation=45, ha="right", rotation_mode="anchor")
+  for label in ax.get_xticklabels(minor=False):
+    label.update({"rotation": 45, "ha": "right", "rotation_mode": "anchor"})
   ax.tick_params(axis="x", which="minor", labelsize="small")
-  plt.xticks(minor=True, rotation=45, ha="right", rotation_mode="anchor")
+  for label in ax.get_xticklabels(minor=True):
+    label.update({"rotation": 45, "ha": "right", "rotation_mode": "anchor"})
 
-  plt.legend(loc="upper left")
+  ax.legend(loc="upper left")
 
   # Matplotlib uses a fixed default size of 640x480 pixels @ 96dpi.
   # By asking for a higher DPI, we can double this to 1280x960 pixels,
   # which fits modern screens better
-  plt.savefig(filename, dpi=192, bbox_inches="tight")
+  fig.savefig(filename, dpi=192, bbox_inches="tight")
 
 def main(argv):
   arguments = parse_args(argv)
@@ -201,7 +156,7 @@ def main(argv):
 
   num_ssimu2_points = len(target_ssimu2_points)
 
-  db = sqlite3.connect(arguments.database)
+  db = open_database_readonly(arguments.database)
 
   # TODO: Get number of resolution points from the database
   # Hard-code for now
@@ -209,7 +164,8 @@ def main(argv):
   resolution_labels = ["1080p", "720p", "480p", "360p"]
 
   print("Computing curves...")
-  (ssimu2_points, log_bpp, log_nspp) = interpolate_fullres_curves(db, selected_encoder, selected_source, target_ssimu2_points)
+  (ssimu2_points, log_bpp, log_nspp) = interpolate_fullres_curves(db, selected_encoder, selected_source,
+                                                                  target_ssimu2_points, arguments.interp)
 
   print("Generating graphs...")
 
@@ -225,8 +181,16 @@ def main(argv):
   size_filename = os.path.join(arguments.output_dir, f"sizes.png")
   runtime_filename = os.path.join(arguments.output_dir, f"runtimes.png")
 
-  plot(size_title, "Size (effective bits/pixel)", resolution_labels, ssimu2_points, log_bpp, size_filename)
-  plot(runtime_title, "Runtime (effective ns/pixel)", resolution_labels, ssimu2_points, log_nspp, runtime_filename)
+  # The two graphs are independent, so render them concurrently
+  with ThreadPoolExecutor(max_workers=2) as executor:
+    futures = [
+      executor.submit(plot, size_title, "Size (effective bits/pixel)", resolution_labels,
+                      ssimu2_points, log_bpp, size_filename),
+      executor.submit(plot, runtime_title, "Runtime (effective ns/pixel)", resolution_labels,
+                      ssimu2_points, log_nspp, runtime_filename),
+    ]
+  for future in futures:
+    future.result()
 
 if __name__ == "__main__":
   main(sys.argv)
@@ -7,16 +7,16 @@
 # was not distributed with this source code in the LICENSE file, you can obtain it at
 # https://opensource.org/license/bsd-2-clause
 
-import matplotlib.pyplot as plt
 import numpy as np
 import os
-import sqlite3
 import sys
 
 from argparse import ArgumentParser
 from collections import namedtuple
-from math import *
+from math import exp
 from matplotlib import ticker
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 
 from common import *
 
@@ -38,6 +38,8 @@ def parse_args(argv):
                       default=None)
   parser.add_argument("--step", help=f"SSIMU2 step size used for interpolation, default {DEFAULT_SSIMU2_STEP}",
                       type=float, default=DEFAULT_SSIMU2_STEP)
+  parser.add_argument("--interp", choices=INTERPOLATION_METHODS, default=DEFAULT_INTERPOLATION,
+                      help=f"Method used to interpolate between data points, default {DEFAULT_INTERPOLATION}")
   parser.add_argument("--multires-plot-1080p-curves", action="store_true",
                       help="Include 1080p-only results as dashed curves on the multires graphs")
   parser.add_argument("curve_specs", nargs="+",
@@ -69,77 +71,20 @@ def parse_args(argv):
 
   return arguments
 
-# Custom function to format the log scale ticks nicely
-# Based on https://stackoverflow.com/a/17209836
 def format_tick(value, _):
-  exp = int(floor(log10(value)))
-  base = int(round(value / 10**exp))
-
-  # Skip labelling the 5, 7, and 9 subdivisions to avoid crowding.
-  # These skipped subdivisions still get a tick mark on the axis to indicate
-  # where they are
-  if base in (5, 7, 9): return ""
-
-  if exp >= 1:
-    return f"{value:.0f}"
-  elif exp == 0:
-    # In this case the tick values are single-digit integers,
-    # but add a decimal place anyway because 0.6, 0.8, 1.0, 2.0, ... looks prettier
-    # than 0.6, 0.8, 1, 2, ...
-    return f"{value:.1f}"
-  else:
-    # For values < 1, display with the minimal number of decimal places
-    fmt = f"%.{-exp:d}f"
-    return fmt % value
-
-def plot(title, metric_label, ssimu2_points, curves, log_metric, filename):
-  fig, ax = plt.subplots()
-  ax.set(xlabel=metric_label, ylabel="SSIMU2")
-  ax.set_title(title)
-
-  num_curves = len(curves)
-
-  has_legend = False
-  for curve_index, curve in enumerate(curves):
-    # Distribute curve colours evenly across the rainbow if there are <12 plots
-    colour_index = (curve_index * len(CURVE_COLOURS)) // num_curves
-    colour = CURVE_COLOURS[colour_index]
-
-    for (index_in_curve, encoder_index) in enumerate(curve.encoder_indices):
-      data = np.exp(log_metric[encoder_index, :])
-
-      style = CURVE_STYLES[index_in_curve]
-
-      # Only add legend entries once, to avoid duplication
-      if index_in_curve == 0 and curve.label != "":
-        legend_entry = curve.label
-        has_legend = True
-      else:
-        legend_entry = None
-
-      ax.semilogx(data, ssimu2_points, color=colour, linestyle=style, label=legend_entry)
-
-  ax.xaxis.set_minor_locator(ticker.LogLocator(subs=[1, 2, 3, 4, 5, 6, 7, 8, 9]))
-  ax.xaxis.set_major_formatter(ticker.FuncFormatter(format_tick))
-  ax.xaxis.set_minor_formatter(ticker.FuncFormatter(format_tick))
-
-  ax.tick_params(axis="x", which="major", labelsize="small")
-  plt.xticks(minor=False, rotation=45, ha="right", rotation_mode="anchor")
-  ax.tick_params(axis="x", which="minor", labelsize="small")
-  plt.xticks(minor=True, rotation=45, ha="right", rotation_mode="anchor")
-
-  if has_legend:
-    # Place legend in the upper left, as curves on this graph go from lower left to top right
-    plt.legend(loc="upper left")
-
-  # Matplotlib uses a fixed default size of 640x480 pixels @ 96dpi.
-  # By asking for a higher DPI, we can double this to 1280x960 pixels,
-  # which fits modern screens better
-  plt.savefig(filename, dpi=192, bbox_inches="tight")
-
-def plot_multires(title, metric_label, ssimu2_points, curves, log_metric, log_fullres_metric,
-                  plot_1080p_curves, filename):
-  fig, ax = plt.subplots()
+  return format_log_tick(value)
+
+# Plot one graph of size or runtime against SSIMU2 score, with one line per encoder.
+# `metric` holds the (linear-space, not log-space) values to plot, indexed as [encoder_index, ssimu2_index].
+# If `fullres_metric` is provided, the corresponding full-res-only curves are also plotted
+# as dashed lines, in the same colour as the main curve for each encoder
+def plot(title, metric_label, ssimu2_points, curves, metric, filename, fullres_metric=None):
+  # Use the object-oriented matplotlib API rather than pyplot. This renders directly with the
+  # Agg backend, without needing to set up an interactive backend first, and means there's
+  # no global figure state to clean up afterwards
+  fig = Figure()
+  FigureCanvasAgg(fig)
+  ax = fig.subplots()
   ax.set(xlabel=metric_label, ylabel="SSIMU2")
   ax.set_title(title)
 
@@ -152,7 +97,7 @@ def plot_multires(title, metric_label, ssimu2_points, curves, log_metric, log_fu
     colour = CURVE_COLOURS[colour_index]
 
     for (index_in_curve, encoder_index) in enumerate(curve.encoder_indices):
-      data = np.exp(log_metric[encoder_index, :])
+      data = metric[encoder_index, :]
 
       style = CURVE_STYLES[index_in_curve]
 
@@ -164,8 +109,8 @@ def plot_multires(title, metric_label, ssimu2_points, curves, log_metric, log_fu
         legend_entry = None
 
       ax.semilogx(data, ssimu2_points, color=colour, linestyle=style, label=legend_entry)
-      if plot_1080p_curves:
-        fullres_data = np.exp(log_fullres_metric[encoder_index, :])
+      if fullres_metric is not None:
+        fullres_data = fullres_metric[encoder_index, :]
         ax.semilogx(fullres_data, ssimu2_points, color=colour, linestyle="--")
 
   ax.xaxis.set_minor_locator(ticker.LogLocator(subs=[1, 2, 3, 4, 5, 6, 7, 8, 9]))
@@ -173,18 +118,20 @@ def plot_multires(title, metric_label, ssimu2_points, curves, log_metric, log_fu
   ax.xaxis.set_minor_formatter(ticker.FuncFormatter(format_tick))
 
   ax.tick_params(axis="x", which="major", labelsize="small")
-  plt.xticks(minor=False, rotation=45, ha="right", rotation_mode="anchor")
+  for label in ax.get_xticklabels(minor=False):
+    label.update({"rotation": 45, "ha": "right", "rotation_mode": "anchor"})
   ax.tick_params(axis="x", which="minor", labelsize="small")
-  plt.xticks(minor=True, rotation=45, ha="right", rotation_mode="anchor")
+  for label in ax.get_xticklabels(minor=True):
+    label.update({"rotation": 45, "ha": "right", "rotation_mode": "anchor"})
 
   if has_legend:
     # Place legend in the upper left, as curves on this graph go from lower left to top right
-    plt.legend(loc="upper left")
+    ax.legend(loc="upper left")
 
   # Matplotlib uses a fixed default size of 640x480 pixels @ 96dpi.
   # By asking for a higher DPI, we can double this to 1280x960 pixels,
   # which fits modern screens better
-  plt.savefig(filename, dpi=192, bbox_inches="tight")
+  fig.savefig(filename, dpi=192, bbox_inches="tight")
 
 def main(argv):
   arguments = parse_args(argv)
@@ -192,10 +139,6 @@ def main(argv):
   target_ssimu2_points = arguments.target_ssimu2_points
 
   num_encoders = len(arguments.encoders)
-  num_sources = len(arguments.sources)
-  num_ssimu2_points = len(target_ssimu2_points)
-
-  db = sqlite3.connect(arguments.database)
 
   # TODO: Get number of resolution points from the database
   # Hard-code for now
@@ -206,22 +149,8 @@ def main(argv):
   # Then we can pull out the requested ones from this array as-needed
   print("Computing curves...")
 
-  mean_log_bpp = np.zeros((num_encoders, num_resolution_points+1, num_ssimu2_points))
-  mean_log_nspp = np.zeros((num_encoders, num_resolution_points+1, num_ssimu2_points))
-
-  for encoder_index, encoder in enumerate(arguments.encoders):
-    for source in arguments.sources:
-      for resolution_index, log_bpp, log_nspp in interpolate_curves(db, encoder, source, target_ssimu2_points):
-        mean_log_bpp[encoder_index, resolution_index] += log_bpp
-        mean_log_nspp[encoder_index, resolution_index] += log_nspp
-
-  # Taking the arithmetic mean in log space is equivalent to taking the
-  # geometric mean of the "true" values
-  mean_log_bpp /= num_sources
-  mean_log_nspp /= num_sources
-
-  # Once all curves are generated, we no longer need to keep the database open
-  db.close()
+  mean_log_bpp, mean_log_nspp = mean_log_curves(arguments.database, arguments.encoders, arguments.sources,
+                                                target_ssimu2_points, num_resolution_points, arguments.interp)
 
   # Print all pairwise Bjøntegaard deltas of size and runtime at the same quality
   # TODO: Decide how to handle multiple source lists here
@@ -294,6 +223,10 @@ def main(argv):
 
   os.makedirs(arguments.output_dir, exist_ok=True)
 
+  # Convert the averaged curves out of log space once, rather than separately for each graph
+  mean_bpp = np.exp(mean_log_bpp)
+  mean_nspp = np.exp(mean_log_nspp)
+
   # Single-res graphs first
   for resolution_index in range(num_resolution_points):
     resolution_label = resolution_labels[resolution_index]
@@ -309,9 +242,9 @@ def main(argv):
     runtime_filename = os.path.join(arguments.output_dir, f"runtimes_{resolution_label}.png")
 
     plot(size_title, "Size (bits/pixel)",
-         target_ssimu2_points, arguments.curves, mean_log_bpp[:, resolution_index, :], size_filename)
+         target_ssimu2_points, arguments.curves, mean_bpp[:, resolution_index, :], size_filename)
     plot(runtime_title, "Runtime (ns/pixel)",
-         target_ssimu2_points, arguments.curves, mean_log_nspp[:, resolution_index, :], runtime_filename)
+         target_ssimu2_points, arguments.curves, mean_nspp[:, resolution_index, :], runtime_filename)
 
   # Multires graph
   if arguments.title is None:
@@ -324,12 +257,19 @@ def main(argv):
   size_filename = os.path.join(arguments.output_dir, "sizes_multires.png")
   runtime_filename = os.path.join(arguments.output_dir, "runtimes_multires.png")
 
-  plot_multires(size_title, "Size (effective bits/pixel)",
-                target_ssimu2_points, arguments.curves, mean_log_bpp[:, num_resolution_points, :], mean_log_bpp[:, 0, :],
-                arguments.multires_plot_1080p_curves, size_filename)
-  plot_multires(runtime_title, "Runtime (effective ns/pixel)",
-                target_ssimu2_points, arguments.curves, mean_log_nspp[:, num_resolution_points, :], mean_log_nspp[:, 0, :],
-                arguments.multires_plot_1080p_curves, runtime_filename)
+  if arguments.multires_plot_1080p_curves:
+    fullres_bpp = mean_bpp[:, 0, :]
+    fullres_nspp = mean_nspp[:, 0, :]
+  else:
+    fullres_bpp = None
+    fullres_nspp = None
+
+  plot(size_title, "Size (effective bits/pixel)",
+       target_ssimu2_points, arguments.curves, mean_bpp[:, num_resolution_points, :], size_filename,
+       fullres_bpp)
+  plot(runtime_title, "Runtime (effective ns/pixel)",
+       target_ssimu2_points, arguments.curves, mean_nspp[:, num_resolution_points, :], runtime_filename,
+       fullres_nspp)
 
 if __name__ == "__main__":
   main(sys.argv)
@@ -7,16 +7,16 @@
 # was not distributed with this source code in the LICENSE file, you can obtain it at
 # https://opensource.org/license/bsd-2-clause
 
-import matplotlib.pyplot as plt
 import numpy as np
 import os
-import sqlite3
 import sys
 
 from argparse import ArgumentParser
 from collections import namedtuple
-from math import *
+from math import exp
 from matplotlib import ticker
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 
 from common import *
 
@@ -40,6 +40,8 @@ def parse_args(argv):
                       default=None)
   parser.add_argument("--step", help=f"SSIMU2 step size used for interpolation, default {DEFAULT_SSIMU2_STEP}",
                       type=float, default=DEFAULT_SSIMU2_STEP)
+  parser.add_argument("--interp", choices=INTERPOLATION_METHODS, default=DEFAULT_INTERPOLATION,
+                      help=f"Method used to interpolate between data points, default {DEFAULT_INTERPOLATION}")
   parser.add_argument("curve_specs", nargs="+", metavar="CURVE",
                       help="Curves to plot, format is label:encoder1:encoder2:...")
 
@@ -67,28 +69,8 @@ def parse_args(argv):
 
   return arguments
 
-# Custom function to format the log scale ticks nicely
-# Based on https://stackoverflow.com/a/17209836
 def format_x_tick(value, _):
-  exp = int(floor(log10(value)))
-  base = int(round(value / 10**exp))
-
-  # Skip labelling the 5, 7, and 9 subdivisions to avoid crowding.
-  # These skipped subdivisions still get a tick mark on the axis to indicate
-  # where they are
-  if base in (5, 7, 9): return ""
-
-  if exp >= 1:
-    return f"{value:.0f}x"
-  elif exp == 0:
-    # In this case the tick values are single-digit integers,
-    # but add a decimal place anyway because 0.6, 0.8, 1.0, 2.0, ... looks prettier
-    # than 0.6, 0.8, 1, 2, ...
-    return f"{value:.1f}x"
-  else:
-    # For values < 1, display with the minimal number of decimal places
-    fmt = f"%.{-exp:d}fx"
-    return fmt % value
+  return format_log_tick(value, "x")
 
 def format_y_tick(value, _):
   return f"{value:+3.0f}%"
@@ -96,7 +78,10 @@ def format_y_tick(value, _):
 def plot_size_vs_runtime(title, curves, reference_encoder_index,
                          representative_log_bpp, representative_log_nspp,
                          filename):
-  fig, ax = plt.subplots()
+  # As in the other plot scripts, draw straight onto an Agg canvas rather than going through pyplot
+  fig = Figure()
+  FigureCanvasAgg(fig)
+  ax = fig.subplots()
   ax.set(xlabel="Relative runtime", ylabel="BDRATE")
   ax.set_title(title)
 
@@ -130,29 +115,28 @@ def plot_size_vs_runtime(title, curves, reference_encoder_index,
   ax.yaxis.set_minor_formatter(ticker.FuncFormatter(format_y_tick))
 
   ax.tick_params(axis="x", which="major", labelsize="small")
-  plt.xticks(minor=False, rotation=45, ha="right", rotation_mode="anchor")
+  for label in ax.get_xticklabels(minor=False):
+    label.update({"rotation": 45, "ha": "right", "rotation_mode": "anchor"})
   ax.tick_params(axis="x", which="minor", labelsize="small")
-  plt.xticks(minor=True, rotation=45, ha="right", rotation_mode="anchor")
+  for label in ax.get_xticklabels(minor=True):
+    label.update({"rotation": 45, "ha": "right", "rotation_mode": "anchor"})
 
   if has_legend:
     # Place legend in the upper right, as curves on this graph go from upper left to bottom right
-    plt.legend(loc="upper right")
+    ax.legend(loc="upper right")
 
   # Matplotlib uses a fixed default size of 640x480 pixels @ 96dpi.
   # By asking for a higher DPI, we can double this to 1280x960 pixels,
   # which fits modern screens better
-  plt.savefig(filename, dpi=192, bbox_inches="tight")
+  fig.savefig(filename, dpi=192, bbox_inches="tight")
 
 def main(argv):
   arguments = parse_args(argv)
 
   target_ssimu2_points = arguments.target_ssimu2_points
 
-  num_encoders = len(arguments.encoders)
   num_ssimu2_points = len(target_ssimu2_points)
 
-  db = sqlite3.connect(arguments.database)
-
   # TODO: Get number of resolution points from the database
   # Hard-code for now
   num_resolution_points = 4
@@ -160,28 +144,14 @@ def main(argv):
 
   print("Computing curves...")
 
-  mean_log_bpp = np.zeros((num_encoders, num_resolution_points+1, num_ssimu2_points))
-  mean_log_nspp = np.zeros((num_encoders, num_resolution_points+1, num_ssimu2_points))
-
   # For simplicity of logic, compute curves for all requested encoders.
   # Then we can pull out the requested ones from this array as-needed
-  for encoder_index, encoder in enumerate(arguments.encoders):
-    for source in arguments.sources:
-      for (resolution_index, log_bpp, log_nspp) in interpolate_curves(db, encoder, source, target_ssimu2_points):
-        mean_log_bpp[encoder_index, resolution_index] += log_bpp
-        mean_log_nspp[encoder_index, resolution_index] += log_nspp
-
-  # Taking the arithmetic mean in log space is equivalent to taking the
-  # geometric mean of the "true" values
-  mean_log_bpp /= len(arguments.sources)
-  mean_log_nspp /= len(arguments.sources)
+  mean_log_bpp, mean_log_nspp = mean_log_curves(arguments.database, arguments.encoders, arguments.sources,
+                                                target_ssimu2_points, num_resolution_points, arguments.interp)
 
   reference_mean_log_bpp = np.zeros((num_resolution_points+1, num_ssimu2_points))
   reference_mean_log_nspp = np.zeros((num_resolution_points+1, num_ssimu2_points))
 
-  # Once all curves are generated, we no longer need to keep the database open
-  db.close()
-
   representative_log_bpp = np.mean(mean_log_bpp, axis=2)
   representative_log_nspp = np.mean(mean_log_nspp, axis=2)
 